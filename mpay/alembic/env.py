@@ -53,6 +53,16 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 
+def do_run_migrations(connection) -> None:
+    context.configure(
+        connection=connection, target_metadata=target_metadata,
+        render_as_batch=True
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
 def run_migrations_online() -> None:
     """Run migrations in 'online' mode.
 
@@ -60,6 +70,12 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
+    # The caller can share its connection (and transaction) with us.
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
     if not programmatic_use:
         connectable = engine_from_config(
             config.get_section(config.config_ini_section, {}),
@@ -70,13 +86,7 @@ def run_migrations_online() -> None:
         connectable = config.attributes["engine"]
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata,
-            render_as_batch=True
-        )
-
-        with context.begin_transaction():
-            context.run_migrations()
+        do_run_migrations(connection)
 
 
 if context.is_offline_mode():
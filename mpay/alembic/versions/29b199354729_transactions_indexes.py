@@ -0,0 +1,40 @@
+"""transactions indexes
+
+Revision ID: 29b199354729
+Revises: 931cbe1524ae
+Create Date: 2026-10-15 22:43:43.548937
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '29b199354729'
+down_revision: Union[str, None] = '931cbe1524ae'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_index('ix_transactions_agent_id', ['agent_id'], unique=False)
+        batch_op.create_index('ix_transactions_standing_order_id', ['standing_order_id'], unique=False)
+        batch_op.create_index('ix_transactions_user_from_id_dt_due_utc', ['user_from_id', 'dt_due_utc'], unique=False)
+        batch_op.create_index('ix_transactions_user_to_id_dt_due_utc', ['user_to_id', 'dt_due_utc'], unique=False)
+
+    with op.batch_alter_table('transactions_tags', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_transactions_tags_tag_id'), ['tag_id'], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('transactions_tags', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_transactions_tags_tag_id'))
+
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_index('ix_transactions_user_to_id_dt_due_utc')
+        batch_op.drop_index('ix_transactions_user_from_id_dt_due_utc')
+        batch_op.drop_index('ix_transactions_standing_order_id')
+        batch_op.drop_index('ix_transactions_agent_id')
@@ -0,0 +1,28 @@
+"""standing orders dt_next_utc index
+
+Revision ID: 92974f9b1fd0
+Revises: 29b199354729
+Create Date: 2026-10-15 23:01:22.036421
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '92974f9b1fd0'
+down_revision: Union[str, None] = '29b199354729'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.batch_alter_table('standing_orders', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_standing_orders_dt_next_utc'), ['dt_next_utc'], unique=False)
+
+
+def downgrade() -> None:
+    with op.batch_alter_table('standing_orders', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_standing_orders_dt_next_utc'))
@@ -2,32 +2,44 @@
 
 import datetime
 import logging
+import typing
 import sqlalchemy as sqa
 from sqlalchemy import (
     create_engine, ForeignKey, PrimaryKeyConstraint, CheckConstraint,
     UniqueConstraint, String, Table, Column, Integer, DDL, insert,
-    MetaData
+    MetaData, Index
 )
 
 from sqlalchemy.orm import (
-    DeclarativeBase, Mapped, mapped_column, relationship
+    DeclarativeBase, Mapped, mapped_column, relationship, InstrumentedAttribute
 )
 
-from sqlalchemy.orm import Session  # noqa: F401
 from sqlalchemy import func  # noqa: F401
 
 from sqlalchemy.types import Numeric
 
 from typing import Optional
+from collections.abc import Iterable
 from decimal import Decimal
 import alembic
 import alembic.config
-import pathlib
+import functools
+import importlib.resources
+import itertools
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class Session(sqa.orm.Session):
+    """ORM session for the mpay database.
+
+    Per-session caches in Session.info are invalidated after flush by an
+    event listener registered on this class only, not on every SQLAlchemy
+    session in the process.
+    """
+
+
 class Base(DeclarativeBase):
     # constraint naming (needed by alembic):
     metadata = MetaData(naming_convention={
@@ -48,7 +60,27 @@ class Base(DeclarativeBase):
     __table_args__: tuple | dict = _mysql_args
 
 
-money_type = Numeric(precision=9, scale=3, asdecimal=True)
+MONEY_SCALE = 3
+money_type = Numeric(precision=9, scale=MONEY_SCALE, asdecimal=True)
+
+
+class _MoneyFloat(sqa.types.TypeDecorator):
+    """Money type that returns float instead of Decimal.
+
+    Reporting queries (dataframes) convert the values to float anyway, so
+    there is no need to construct Decimal objects first.
+    """
+    impl = Numeric
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # sqlite returns int for whole numbers and does not round to scale
+        return round(float(value), MONEY_SCALE)
+
+
+money_type_float = _MoneyFloat(precision=9, scale=MONEY_SCALE, asdecimal=False)
 
 
 def aware_utcnow():
@@ -99,6 +131,79 @@ class Tag(Base):
         return self.parent.hierarchical_name + "/" + self.name
 
 
+def get_tag_tree(session: Session) -> dict[int, str]:
+    """Get hierarchical names of all tags, indexed by tag id.
+
+    The whole tags table is loaded with a single query and the result is
+    cached in session.info until a Tag is flushed.
+    """
+    if session.autoflush and any(isinstance(o, Tag) for o in (*session.new, *session.dirty, *session.deleted)):
+        # a query would autoflush pending tags, the cache must not hide them
+        session.flush()
+
+    tree: Optional[dict[int, str]] = session.info.get("tag_tree")
+    if tree is not None:
+        return tree
+
+    children: dict[Optional[int], list[tuple[int, str]]] = {}
+    for tag_id, name, parent_id in session.execute(sqa.select(Tag.id, Tag.name, Tag.parent_id)):
+        children.setdefault(parent_id, []).append((tag_id, name))
+
+    tree = {}
+    queue = [(tag_id, name) for tag_id, name in children.get(None, [])]
+    while queue:
+        tag_id, hierarchical_name = queue.pop()
+        tree[tag_id] = hierarchical_name
+        queue.extend(
+            (child_id, hierarchical_name + "/" + name)
+            for child_id, name in children.get(tag_id, [])
+        )
+
+    session.info["tag_tree"] = tree
+    return tree
+
+
+def get_ids_by(session: Session, column: InstrumentedAttribute, values: Iterable) -> dict[typing.Any, Optional[int]]:
+    """Get ids of rows whose unique column equals one of values.
+
+    Meant for resolving names of users, agents, currencies etc. Values that
+    are not cached yet are looked up with a single query. Results
+    (including misses) are cached in session.info until an object of the
+    same class is flushed.
+
+    :return: ids indexed by value, None for values with no such row
+    """
+    cache: dict[tuple, Optional[int]] = session.info.setdefault("id_cache", {})
+    keys = {value: (column.class_, column.key, value) for value in values}
+    missing = [value for value, key in keys.items() if key not in cache]
+    if missing:
+        found: dict[typing.Any, int] = dict(session.execute(
+            sqa.select(column, column.class_.id).where(column.in_(missing))
+        ).all())
+        for value in missing:
+            cache[keys[value]] = found.get(value)
+    return {value: cache[key] for value, key in keys.items()}
+
+
+def get_id_by(session: Session, column: InstrumentedAttribute, value) -> Optional[int]:
+    """Get id of the row whose unique column equals value, see get_ids_by.
+
+    :return: id, or None if there is no such row
+    """
+    return get_ids_by(session, column, [value])[value]
+
+
+@sqa.event.listens_for(Session, "after_flush")
+def _invalidate_caches(session, flush_context):
+    flushed = {type(o) for o in (*session.new, *session.dirty, *session.deleted)}
+    if Tag in flushed:
+        session.info.pop("tag_tree", None)
+    id_cache = session.info.get("id_cache")
+    if id_cache:
+        for key in [k for k in id_cache if k[0] in flushed]:
+            del id_cache[key]
+
+
 class Agent(Base):
     __tablename__ = "agents"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -120,7 +225,8 @@ class StandingOrder(Base):
     rrule_str: Mapped[str] = mapped_column(String(255))
     # UTC date when next transaction should occur or None for disabled /
     # expired order. Cannot be recovered once set to None.
-    dt_next_utc: Mapped[Optional[datetime.datetime]]
+    # indexed for the due orders lookup in execute_orders
+    dt_next_utc: Mapped[Optional[datetime.datetime]] = mapped_column(index=True)
     dt_created_utc: Mapped[datetime.datetime] = mapped_column(default=aware_utcnow)
     __table_args__ = (
         UniqueConstraint("name", "user_from_id"),
@@ -178,6 +284,11 @@ class Transaction(Base):
         CheckConstraint("dt_due_utc <= dt_created_utc", "dt_due_not_in_future"),
         CheckConstraint("converted_amount >= 0", "converted_amount_ge_zero"),
         CheckConstraint("original_amount >= 0 OR original_amount IS NULL", "original_amount_ge_zero"),
+        # history is filtered by user and ordered by due date
+        Index("ix_transactions_user_from_id_dt_due_utc", "user_from_id", "dt_due_utc"),
+        Index("ix_transactions_user_to_id_dt_due_utc", "user_to_id", "dt_due_utc"),
+        Index("ix_transactions_agent_id", "agent_id"),
+        Index("ix_transactions_standing_order_id", "standing_order_id"),
         Base._mysql_args
     )
 
@@ -227,7 +338,9 @@ transactions_tags = Table(
     Column("transaction_id", Integer,
            ForeignKey(Transaction.__tablename__ + ".id", ondelete="CASCADE")),
     Column("tag_id", Integer,
-           ForeignKey(Tag.__tablename__ + ".id", ondelete="CASCADE")),
+           ForeignKey(Tag.__tablename__ + ".id", ondelete="CASCADE"),
+           # the primary key index cannot be used to look up by tag_id
+           index=True),
     PrimaryKeyConstraint("transaction_id", "tag_id"),
 )
 
@@ -240,10 +353,10 @@ history_select = (
         Transaction.id,
         _user_from.name.label("from"),
         _user_to.name.label("to"),
-        Transaction.converted_amount.label("amount"),
+        sqa.type_coerce(Transaction.converted_amount, money_type_float).label("amount"),
         Transaction.note,
         Currency.iso_4217.label("orig. currency"),
-        Transaction.original_amount.label("orig. amount"),
+        sqa.type_coerce(Transaction.original_amount, money_type_float).label("orig. amount"),
         Agent.name.label("agent"),
         # Standing order name is not unique, but (user_from, name)
         # is, and the order's user_from matches the transaction's
@@ -270,27 +383,109 @@ history_select = (
 )
 
 
-def alembic_config(db_engine) -> alembic.config.Config:
-    alembic_cfg_file = pathlib.Path(__file__).parents[0] / "alembic.ini"
+# Built once, SQLAlchemy then reuses the compiled form from its cache.
+_insert_transactions = insert(Transaction)
+# SQLite cannot return ids of a multi-row INSERT in a guaranteed order, so
+# SQLAlchemy executes this one row by row. MySQL has no RETURNING at all,
+# see bulk_create_transactions.
+_insert_transactions_returning = insert(Transaction).returning(Transaction.id, sort_by_parameter_order=True)
+
+
+def bulk_create_transactions(
+    session: Session,
+    rows: Iterable[dict],
+    batch_size: int = 1000,
+    return_ids: bool = False
+) -> list[int]:
+    """Insert multiple transactions with executemany.
+
+    rows are consumed in batches of batch_size, so they can be supplied by a
+    generator and do not need to be materialized all at once.
+    User balances are still maintained by the database triggers.
+
+    Transaction ids are only fetched if they are needed (return_ids or
+    tag_ids are given), because that prevents batching rows into multi-row
+    INSERT statements. Without ordered RETURNING support (MySQL), such rows
+    are inserted one by one.
+
+    :param rows: dicts with Transaction column values, optionally with
+                 "tag_ids" - ids of tags to attach to the transaction
+    :return: ids of the created transactions in the order of rows if
+             return_ids is set, empty list otherwise
+    """
+    ids: list[int] = []
+    rows = iter(rows)
+    returning = session.get_bind().dialect.insert_executemany_returning_sort_by_parameter_order
+    while batch := list(itertools.islice(rows, batch_size)):
+        tag_ids = [row.get("tag_ids", ()) for row in batch]
+        need_ids = return_ids or any(tag_ids)
+        values = [{k: v for k, v in row.items() if k != "tag_ids"} for row in batch]
+        if need_ids and not returning:
+            # one INSERT per row, the id is read from the cursor's lastrowid
+            connection = session.connection()
+            batch_ids = [connection.execute(_insert_transactions, row).lastrowid for row in values]
+        else:
+            result = session.execute(
+                _insert_transactions_returning if need_ids else _insert_transactions,
+                values,
+                # keep all rows in one batch even if some optional columns
+                # are None (rows must still have the same keys)
+                execution_options={"render_nulls": True},
+            )
+            if not need_ids:
+                continue
+            batch_ids = list(result.scalars())
+
+        links = [
+            {"transaction_id": transaction_id, "tag_id": tag_id}
+            for transaction_id, row_tag_ids in zip(batch_ids, tag_ids)
+            for tag_id in row_tag_ids
+        ]
+        if links:
+            session.execute(insert(transactions_tags), links)
+        if return_ids:
+            ids.extend(batch_ids)
+    return ids
+
+
+@functools.cache
+def _alembic_cfg_file() -> str:
+    alembic_cfg_file = importlib.resources.files(__package__) / "alembic.ini"
     _LOGGER.debug("alembic config file: %s", alembic_cfg_file)
-    if not alembic_cfg_file.exists():
+    if not alembic_cfg_file.is_file():
         raise Exception(f"Alembic config file does not exist: {alembic_cfg_file}")
-    alembic_cfg = alembic.config.Config(alembic_cfg_file)
+    return str(alembic_cfg_file)
+
+
+def alembic_config(db_engine) -> alembic.config.Config:
+    alembic_cfg = alembic.config.Config(_alembic_cfg_file())
     alembic_cfg.set_main_option("sqlalchemy.url", "")
     alembic_cfg.attributes["engine"] = db_engine
     return alembic_cfg
 
 
 def connect(db_url: str) -> sqa.engine.Engine:
-    engine = create_engine(db_url)
+    engine_kwargs: dict[str, typing.Any] = {}
+    if sqa.engine.make_url(db_url).get_backend_name() != "sqlite":
+        # The server closes idle connections (MySQL wait_timeout), which
+        # would break long-running processes like the interactive CLI.
+        engine_kwargs.update(pool_pre_ping=True, pool_recycle=3600)
+
+    engine = create_engine(db_url, **engine_kwargs)
 
     dialect_name = engine.dialect.name
     _LOGGER.info("db engine dialect name: %s", dialect_name)
-    if "sqlite" in dialect_name.lower():
+    if dialect_name == "sqlite":
         def set_sqlite_pragma(dbapi_connection, connection_record):
             _LOGGER.info("setting sqlite pragmas")
             cursor = dbapi_connection.cursor()
             cursor.execute("PRAGMA foreign_keys=ON")
+            # WAL lets readers proceed while a write is in progress, and
+            # with synchronous=NORMAL commits do not wait for fsync (only
+            # checkpoints do). The database stays consistent after a power
+            # loss, only the last commits may be lost.
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
             cursor.close()
 
         sqa.event.listen(engine, "connect", set_sqlite_pragma)
@@ -322,15 +517,19 @@ def setup_database(db_engine) -> None:
     # this time.
 
     alembic_cfg = alembic_config(db_engine)
-    alembic.command.upgrade(alembic_cfg, "head")
 
-    # Populate currencies table with most commonly used values.
-    with Session(db_engine) as session:
+    # Run the migrations and populate the currencies table on a single
+    # connection in a single transaction.
+    with db_engine.begin() as conn:
+        alembic_cfg.attributes["connection"] = conn
+        alembic.command.upgrade(alembic_cfg, "head")
+
+        # Populate currencies table with most commonly used values.
         CURRENCIES = {
             "USD": "United States dollar",
             "EUR": "Euro",
         }
-        session.execute(
+        conn.execute(
             insert(Currency)
             .prefix_with("OR IGNORE", dialect="sqlite")
             .prefix_with("IGNORE", dialect="mysql"),
@@ -339,4 +538,3 @@ def setup_database(db_engine) -> None:
                 for iso_4217, name in CURRENCIES.items()
             ],
         )
-        session.commit()
@@ -1,9 +1,21 @@
+import itertools
 import tkinter as tk
 import tkinter.ttk as ttk
+from collections.abc import Iterable
+import numpy as np
+import pandas as pd
 
 
 class DfGUI(tk.Frame):
-    """Generic pandas dataframe view."""
+    """Generic pandas dataframe view.
+
+    Rows are inserted into the Treeview a page at a time, from the Tk event
+    loop, so the window is responsive while a large dataframe is loaded.
+    Scrolling close to the last inserted row inserts the next page right
+    away.
+    """
+
+    page_size = 200
 
     def __init__(self, parent, df):
         super().__init__(parent)
@@ -13,11 +25,11 @@ class DfGUI(tk.Frame):
         self.create_widgets()
 
     def create_widgets(self):
-        self.columns: list[str] = list(self.df)
+        self.columns: tuple[str, ...] = tuple(self.df.columns)
         self.trv = ttk.Treeview(self.parent, show="headings", columns=self.columns)
 
         self.vsb = ttk.Scrollbar(self.parent, orient="vertical", command=self.trv.yview)
-        self.trv.configure(yscrollcommand=self.vsb.set)
+        self.trv.configure(yscrollcommand=self.on_yscroll)
         self.vsb.pack(side=tk.RIGHT, fill=tk.Y)
         self.trv.pack(fill=tk.BOTH, side=tk.LEFT, expand=True)
 
@@ -28,8 +40,43 @@ class DfGUI(tk.Frame):
             self.trv.column(col, anchor=tk.CENTER)
             self.trv.heading(col, text=col)
 
-        for _, row in self.df.iterrows():
-            self.trv.insert("", "end", iid=row.id, values=row.tolist())
+        self.inserted_rows = 0
+        self.insert_rows(self.page_size)
+        self.after_idle(self.insert_pending_rows)
+
+    def row_tags(self, df: pd.DataFrame) -> Iterable[tuple[str, ...]]:
+        """Get Treeview tags for each row of df."""
+        return itertools.repeat(())
+
+    def insert_rows(self, count: int) -> None:
+        """Insert up to count rows that are not in the Treeview yet."""
+        if self.inserted_rows >= len(self.df):
+            return
+        page = self.df.iloc[self.inserted_rows:self.inserted_rows + count]
+        self.inserted_rows += len(page)
+
+        ids = page["id"].to_numpy()
+        # format the whole page with pandas instead of leaving the conversion
+        # of each cell to tkinter, missing values are shown as <NA>
+        values = page.astype(object).fillna("<NA>").astype(str).to_numpy()
+
+        # hide all columns while inserting to suppress intermediate redraws
+        displaycolumns = self.trv.cget("displaycolumns")
+        self.trv.configure(displaycolumns=())
+        for iid, row_values, tags in zip(ids, values, self.row_tags(page)):
+            self.trv.insert("", "end", iid=int(iid), values=tuple(row_values), tags=tags)
+        self.trv.configure(displaycolumns=displaycolumns)
+
+    def insert_pending_rows(self) -> None:
+        self.insert_rows(self.page_size)
+        if self.inserted_rows < len(self.df):
+            # yield to the event loop between pages
+            self.after(1, self.insert_pending_rows)
+
+    def on_yscroll(self, first, last):
+        self.vsb.set(first, last)
+        if float(last) > 0.9:
+            self.insert_rows(self.page_size)
 
 
 class HistoryDfGUI(DfGUI):
@@ -38,17 +85,14 @@ class HistoryDfGUI(DfGUI):
         super().__init__(parent, df)
 
     def fill_trv(self):
-        for col in self.columns:
-            self.trv.column(col, anchor=tk.CENTER)
-            self.trv.heading(col, text=col)
-
-        for _, row in self.df.iterrows():
-            self.trv.insert("", "end", iid=row.id, values=row.tolist(),
-                            tags="incoming" if row["to"] == self.user_me else "outgoing")
-
+        super().fill_trv()
         self.trv.tag_configure("outgoing", background="#ffb3b3")
         self.trv.tag_configure("incoming", background="#b3ffb3")
 
+    def row_tags(self, df: pd.DataFrame) -> Iterable[tuple[str, ...]]:
+        tags = np.where(df["to"].to_numpy() == self.user_me, "incoming", "outgoing")
+        return ((tag,) for tag in tags)
+
 
 def show_df(df, view=DfGUI, *args):
     root = tk.Tk()
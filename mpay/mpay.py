@@ -5,33 +5,62 @@ the user might want to do with the database in a UI-independent way.
 """
 
 import datetime
+import functools
 import re
 import logging
 import dateutil.rrule
 import sqlalchemy as sqa
+import numpy as np
 import pandas as pd
 from decimal import Decimal
-from typing import Optional
-from collections.abc import Iterable
+from typing import Literal, Optional
+from collections.abc import Iterable, Iterator
 from .config import Config
 from . import db
 
 _LOGGER = logging.getLogger(__name__)
 
+_USER_NAME_RE = re.compile(r"[a-z0-9_]+")
+# tag, order and agent names
+_NAME_RE = re.compile(r"[a-zA-Z0-9_-]+")
 
-def _print_tag_tree(tag: db.Tag, last: bool = True, header: str = "") -> str:
+DtypeBackend = Literal["numpy_nullable", "pyarrow"]
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_rrule(rrule_str: str) -> dateutil.rrule.rrule | dateutil.rrule.rruleset:
+    """Parse an rrule string, memoizing the result.
+
+    Standing orders often share the same rrule_str and the parsed rrule
+    is never modified, so it is safe to reuse it. cache=True lets orders
+    sharing the rule reuse occurrences that were already generated.
+    """
+    return dateutil.rrule.rrulestr(rrule_str, cache=True)
+
+
+def _to_decimal(amount) -> Decimal:
+    """Convert an amount to Decimal.
+
+    Going through str gives Decimal("0.6") for 0.6, not the exact binary
+    value of the float.
+    """
+    if isinstance(amount, Decimal):
+        return amount
+    return Decimal(str(amount))
+
+
+def _print_tag_tree(tag: db.Tag, parts: list[str], last: bool = True, header: str = "") -> None:
+    """Append lines of the tag tree under tag to parts."""
     elbow = "└──"
     pipe = "│  "
     tee = "├──"
     blank = "   "
 
-    ret = (f"{header}{elbow if last else tee}"
-           f"{tag.name}\t{tag.description if tag.description is not None else ''}"
-           "\n")
+    parts.append(f"{header}{elbow if last else tee}"
+                 f"{tag.name}\t{tag.description if tag.description is not None else ''}"
+                 "\n")
     for i, c in enumerate(tag.children):
-        ret += _print_tag_tree(c, header=header + (blank if last else pipe), last=i == len(tag.children) - 1)
-
-    return ret
+        _print_tag_tree(c, parts, header=header + (blank if last else pipe), last=i == len(tag.children) - 1)
 
 
 class MpayException(Exception):
@@ -45,6 +74,8 @@ class MpayValueError(ValueError, MpayException):
 class Mpay:
     def __init__(self, config: Config, setup_database: bool = False):
         self.config = config
+        # (user name, user id)
+        self._current_user: Optional[tuple[str, int]] = None
         self.db_engine = db.connect(config.db_url)
         if setup_database:
             db.setup_database(self.db_engine)
@@ -54,6 +85,20 @@ class Mpay:
     def __del__(self):
         self.db_engine.dispose()
 
+    def _get_current_user_id(self, session) -> int:
+        """Get id of the user from config.
+
+        User ids never change, so the id is cached in this object. The cache
+        is keyed by the name, because config can be replaced or modified.
+        """
+        user_name = self.config.user
+        if self._current_user is None or self._current_user[0] != user_name:
+            user_id = db.get_id_by(session, db.User.name, user_name)
+            if user_id is None:
+                raise MpayException("current user does not exist in the database")
+            self._current_user = (user_name, user_id)
+        return self._current_user[1]
+
     @staticmethod
     def ask_confirmation(question: str) -> bool:
         """Ask the user for confirmation.
@@ -64,50 +109,113 @@ class Mpay:
         return True
 
     def create_user(self, username: str) -> None:
-        username = self.sanitize_user_name(username)
+        self.create_users([username])
+
+    def create_users(self, usernames: Iterable[str]) -> None:
+        """Create several users in a single INSERT."""
+        rows = [{"name": self.sanitize_user_name(username), "balance": 0} for username in usernames]
+        if not rows:
+            return
         with db.Session(self.db_engine) as session:
-            u = db.User(name=username, balance=0)
-            session.add(u)
+            session.execute(sqa.insert(db.User), rows)
             session.commit()
 
     def get_tag_tree_str(self) -> str:
         with db.Session(self.db_engine) as session:
-            root_tags = session.query(db.Tag).filter_by(parent=None).all()
-            ret = ""
+            root_tags = session.scalars(
+                sqa.select(db.Tag)
+                .where(db.Tag.parent_id.is_(None))
+                # one query per tree level instead of one per tag
+                .options(sqa.orm.selectinload(db.Tag.children, recursion_depth=-1))
+            ).all()
+            parts: list[str] = []
             for i, t in enumerate(root_tags):
-                ret += _print_tag_tree(t, i == len(root_tags)-1)
-            return ret
+                _print_tag_tree(t, parts, i == len(root_tags)-1)
+            return "".join(parts)
 
-    def _sql2df(self, statement, session) -> pd.DataFrame:
-        # numpy_nullable can represent an int column with NULL values.
+    def _sql2df_chunks(
+        self,
+        statement,
+        session,
+        chunksize: int = 10000,
+        dtype_backend: DtypeBackend = "numpy_nullable",
+    ) -> Iterator[pd.DataFrame]:
+        # Rows are fetched from a server-side cursor chunksize at a time, so
+        # the DBAPI does not buffer the whole result next to the dataframe.
+        statement = statement.execution_options(stream_results=True, max_row_buffer=chunksize)
+        # Both backends can represent an int column with NULL values.
         # This is necessary to prevent converting id to float.
-        return pd.read_sql(statement, session.bind,
-                           dtype_backend='numpy_nullable')
+        # pyarrow is an optional dependency.
+        yield from pd.read_sql(statement, session.connection(), chunksize=chunksize,
+                               dtype_backend=dtype_backend)
 
-    def get_tags_dataframe(self) -> pd.DataFrame:
-        with db.Session(self.db_engine) as session:
-            return self._sql2df(session.query(db.Tag).statement, session)
-
-    def get_users_dataframe(self) -> pd.DataFrame:
+    def _sql2df(
+        self,
+        statement,
+        session,
+        dtype_backend: DtypeBackend = "numpy_nullable",
+    ) -> pd.DataFrame:
+        chunks = list(self._sql2df_chunks(statement, session, dtype_backend=dtype_backend))
+        if len(chunks) == 1:
+            return chunks[0]
+
+        # A column that is all NULL in a chunk gets a different dtype there.
+        # Use the dtype inferred from actual values, so that pd.concat does
+        # not fall back to object.
+        dtypes = {}
+        for chunk in chunks:
+            for column in chunk.columns:
+                if column not in dtypes and chunk[column].notna().any():
+                    dtypes[column] = chunk[column].dtype
+        return pd.concat([chunk.astype(dtypes) for chunk in chunks], ignore_index=True)
+
+    def get_tags_dataframe(self, dtype_backend: DtypeBackend = "numpy_nullable") -> pd.DataFrame:
         with db.Session(self.db_engine) as session:
-            return self._sql2df(session.query(db.User).statement, session)
+            return self._sql2df(sqa.select(*db.Tag.__table__.c), session, dtype_backend)
 
-    def get_transactions_dataframe(self) -> pd.DataFrame:
+    def get_users_dataframe(self, dtype_backend: DtypeBackend = "numpy_nullable") -> pd.DataFrame:
         with db.Session(self.db_engine) as session:
-            try:
-                me = session.query(db.User).filter_by(name=self.config.user).one()
-            except sqa.exc.NoResultFound:
-                raise MpayException("current user does not exist in the database")
-
             return self._sql2df(
-                db.history_select
-                .where(
-                    (db.Transaction.user_from_id == me.id) |
-                    (db.Transaction.user_to_id == me.id)
+                sqa.select(
+                    db.User.id,
+                    db.User.name,
+                    sqa.type_coerce(db.User.balance, db.money_type_float).label("balance"),
                 ),
-                session
+                session,
+                dtype_backend
             )
 
+    def _transactions_select(self, session) -> sqa.Select:
+        me_id = self._get_current_user_id(session)
+        return db.history_select.where(
+            (db.Transaction.user_from_id == me_id) |
+            (db.Transaction.user_to_id == me_id)
+        )
+
+    def get_transactions_dataframe(self, dtype_backend: DtypeBackend = "numpy_nullable") -> pd.DataFrame:
+        """Get transaction history of the current user.
+
+        dtype_backend="pyarrow" (requires pyarrow) stores the string columns
+        more compactly.
+        """
+        with db.Session(self.db_engine) as session:
+            return self._sql2df(self._transactions_select(session), session, dtype_backend)
+
+    def iter_transactions_dataframe(
+        self,
+        chunksize: int = 10000,
+        dtype_backend: DtypeBackend = "numpy_nullable",
+    ) -> Iterator[pd.DataFrame]:
+        """Get transaction history in chunks of at most chunksize rows.
+
+        Unlike get_transactions_dataframe, the whole history is never held in
+        memory at once. A column with only NULL values in a chunk may have a
+        different dtype than in the other chunks.
+        """
+        with db.Session(self.db_engine) as session:
+            yield from self._sql2df_chunks(self._transactions_select(session), session, chunksize,
+                                           dtype_backend)
+
     def get_orders_dataframe(self) -> pd.DataFrame:
         with db.Session(self.db_engine) as session:
             user_from = sqa.orm.aliased(db.User)
@@ -118,7 +226,7 @@ class Mpay:
                     db.StandingOrder.name,
                     user_from.name.label("user_from"),
                     user_to.name.label("user_to"),
-                    db.StandingOrder.amount,
+                    sqa.type_coerce(db.StandingOrder.amount, db.money_type_float).label("amount"),
                     db.StandingOrder.note,
                     db.StandingOrder.rrule_str,
                     db.StandingOrder.dt_next_utc,
@@ -131,44 +239,65 @@ class Mpay:
 
     def sanitize_user_name(self, username: str) -> str:
         username = username.strip()
-        if not re.match(r"^[a-z0-9_]+$", username):
+        if not _USER_NAME_RE.fullmatch(username):
             raise MpayValueError("username can only contain lowercase letters, numbers and underscore")
         return username
 
+    @staticmethod
+    def _sanitize_name(name: str, kind: str) -> str:
+        name = name.strip()
+        if not name:
+            raise MpayValueError(f"{kind} name must not be empty")
+        if not _NAME_RE.fullmatch(name):
+            raise MpayValueError(f"{kind} name can only contain letters, numbers, dash and underscore")
+        return name
+
     def sanitize_tag_name(self, tag_name: str) -> str:
-        tag_name = tag_name.strip()
-        if not tag_name:
-            raise MpayValueError("tag name must not be empty")
-        if not re.match(r"^[a-zA-Z0-9_-]+$", tag_name):
-            raise MpayValueError("tag name can only contain letters, numbers, dash and underscore")
-        return tag_name
+        return self._sanitize_name(tag_name, "tag")
 
     def sanitize_order_name(self, order_name: str) -> str:
-        order_name = order_name.strip()
-        if not order_name:
-            raise MpayValueError("order name must not be empty")
-        if not re.match(r"^[a-zA-Z0-9_-]+$", order_name):
-            raise MpayValueError("order name can only contain letters, numbers, dash and underscore")
-        return order_name
+        return self._sanitize_name(order_name, "order")
 
     def sanitize_agent_name(self, agent_name: str) -> str:
-        agent_name = agent_name.strip()
-        if not agent_name:
-            raise MpayValueError("agent name must not be empty")
-        if not re.match(r"^[a-zA-Z0-9_-]+$", agent_name):
-            raise MpayValueError("agent name can only contain letters, numbers, dash and underscore")
-        return agent_name
+        return self._sanitize_name(agent_name, "agent")
 
     def find_tag(self, hierarchical_name: str, session) -> db.Tag:
-        """Find a tag by its hierarchical_name."""
-        path = hierarchical_name.strip().split("/")
+        """Find a tag by its hierarchical_name.
 
-        parent = None
-        for t in path:
-            current: db.Tag = session.query(db.Tag).filter_by(name=t, parent=parent).one()
-            parent = current
+        :raises sqa.exc.NoResultFound: if the tag does not exist
+        """
+        tag = self.find_tags([hierarchical_name], session).get(hierarchical_name)
+        if tag is None:
+            raise sqa.exc.NoResultFound(f"tag {hierarchical_name} does not exist")
+        return tag
 
-        return current
+    @staticmethod
+    def _tag_ids_by_name(session) -> dict[str, int]:
+        return {name: tag_id for tag_id, name in db.get_tag_tree(session).items()}
+
+    def find_tags(self, hierarchical_names: Iterable[str], session) -> dict[str, db.Tag]:
+        """Find multiple tags by their hierarchical_names.
+
+        :return: found tags indexed by hierarchical_name, names of tags that
+                 do not exist are left out
+        """
+        hierarchical_names = list(hierarchical_names)
+        if not hierarchical_names:
+            return {}
+
+        ids_by_name = self._tag_ids_by_name(session)
+        ids = {
+            hierarchical_name: ids_by_name[hierarchical_name.strip()]
+            for hierarchical_name in hierarchical_names
+            if hierarchical_name.strip() in ids_by_name
+        }
+        if not ids:
+            return {}
+        tags = {
+            t.id: t
+            for t in session.scalars(sqa.select(db.Tag).where(db.Tag.id.in_(ids.values())))
+        }
+        return {hierarchical_name: tags[tag_id] for hierarchical_name, tag_id in ids.items()}
 
     def create_hierarchical_tag(self, hierarchical_name: str, session) -> db.Tag:
         """Create a tag from a hierarchical_name.
@@ -180,14 +309,22 @@ class Mpay:
         than one tag.
         """
         path = hierarchical_name.strip().split("/")
-
-        parent = None
-        for t in path:
-            current: Optional[db.Tag] = session.query(db.Tag).filter_by(name=t, parent=parent).one_or_none()
-            if current is None:
-                current = db.Tag(name=self.sanitize_tag_name(t), parent=parent)
-                session.add(current)
-            parent = current
+        ids_by_name = self._tag_ids_by_name(session)
+
+        # Find the longest prefix of path that already exists, only the rest
+        # needs to be created.
+        current: Optional[db.Tag] = None
+        existing_depth = 0
+        for depth in range(len(path), 0, -1):
+            tag_id = ids_by_name.get("/".join(path[:depth]))
+            if tag_id is not None:
+                current = session.get(db.Tag, tag_id)
+                existing_depth = depth
+                break
+
+        for t in path[existing_depth:]:
+            current = db.Tag(name=self.sanitize_tag_name(t), parent=current)
+            session.add(current)
 
         assert current is not None  # make mypy happy
         return current
@@ -200,36 +337,57 @@ class Mpay:
     ) -> None:
         tag_name = self.sanitize_tag_name(tag_name)
         with db.Session(self.db_engine) as session:
-            parent = None
-            if parent_hierarchical_name is not None:
-                try:
-                    parent = self.find_tag(parent_hierarchical_name, session)
-                except sqa.exc.NoResultFound:
+            if parent_hierarchical_name is None:
+                session.add(db.Tag(name=tag_name, description=description))
+            else:
+                # INSERT ... SELECT, the database looks up the parent by
+                # joining one tags alias per path segment.
+                path = parent_hierarchical_name.strip().split("/")
+                path_tags = [sqa.orm.aliased(db.Tag) for _ in path]
+                select_parent = (
+                    sqa.select(sqa.literal(tag_name), sqa.literal(description, sqa.String), path_tags[-1].id)
+                    .select_from(path_tags[0])
+                    .where(path_tags[0].parent_id.is_(None), path_tags[0].name == path[0])
+                )
+                for parent, child, name in zip(path_tags, path_tags[1:], path[1:]):
+                    select_parent = (
+                        select_parent
+                        .join(child, child.parent_id == parent.id)
+                        .where(child.name == name)
+                    )
+                result = session.connection().execute(
+                    sqa.insert(db.Tag).from_select(["name", "description", "parent_id"], select_parent)
+                )
+                if result.rowcount == 0:
                     raise MpayException(f"parent tag '{parent_hierarchical_name}' does not exist")
-            t = db.Tag(name=tag_name, description=description, parent=parent)
-            session.add(t)
             session.commit()
 
     def add_tags(
         self,
-        transaction_ids: Iterable[int] = [],
-        tag_hierarchical_names: Iterable[str] = [],
+        transaction_ids: Iterable[int] = (),
+        tag_hierarchical_names: Iterable[str] = (),
     ) -> None:
         """Add tags to existing transactions."""
         with db.Session(self.db_engine) as session:
+            tag_hierarchical_names = list(tag_hierarchical_names)
+            found_tags = self.find_tags(tag_hierarchical_names, session)
             tags = set()
             for tag_hierarchical_name in tag_hierarchical_names:
-                try:
-                    tag = self.find_tag(tag_hierarchical_name, session)
-                except sqa.exc.NoResultFound:
+                tag = found_tags.get(tag_hierarchical_name)
+                if tag is None:
                     if not self.ask_confirmation(f"Tag {tag_hierarchical_name} does not exist. Create?"):
                         raise MpayException(f"tag {tag_hierarchical_name} does not exist")
                     tag = self.create_hierarchical_tag(tag_hierarchical_name, session)
+                    found_tags[tag_hierarchical_name] = tag
                 tags.add(tag)
 
             for transaction_id in transaction_ids:
                 try:
-                    transaction = session.query(db.Transaction).filter_by(id=transaction_id).one()
+                    transaction = session.scalars(
+                        sqa.select(db.Transaction)
+                        .where(db.Transaction.id == transaction_id)
+                        .options(sqa.orm.selectinload(db.Transaction.tags))
+                    ).one()
                 except sqa.exc.NoResultFound:
                     raise MpayException(f"transaction with id {transaction_id} does not exist")
                 transaction.tags.extend(tags)
@@ -239,22 +397,25 @@ class Mpay:
 
     def remove_tags(
         self,
-        transaction_ids: Iterable[int] = [],
-        tag_hierarchical_names: Iterable[str] = [],
+        transaction_ids: Iterable[int] = (),
+        tag_hierarchical_names: Iterable[str] = (),
     ) -> None:
         """Remove existing tags from existing transactions."""
         with db.Session(self.db_engine) as session:
-            tags = set()
+            tag_hierarchical_names = list(tag_hierarchical_names)
+            found_tags = self.find_tags(tag_hierarchical_names, session)
             for tag_hierarchical_name in tag_hierarchical_names:
-                try:
-                    tag = self.find_tag(tag_hierarchical_name, session)
-                except sqa.exc.NoResultFound:
+                if tag_hierarchical_name not in found_tags:
                     raise MpayException(f"tag {tag_hierarchical_name} does not exist")
-                tags.add(tag)
+            tags = set(found_tags.values())
 
             for transaction_id in transaction_ids:
                 try:
-                    transaction = session.query(db.Transaction).filter_by(id=transaction_id).one()
+                    transaction = session.scalars(
+                        sqa.select(db.Transaction)
+                        .where(db.Transaction.id == transaction_id)
+                        .options(sqa.orm.selectinload(db.Transaction.tags))
+                    ).one()
                 except sqa.exc.NoResultFound:
                     raise MpayException(f"transaction with id {transaction_id} does not exist")
                 transaction.tags = list(set(transaction.tags) - tags)
@@ -267,11 +428,18 @@ class Mpay:
         transaction_id: int
     ) -> set["str"]:
         with db.Session(self.db_engine) as session:
-            try:
-                transaction = session.query(db.Transaction).filter_by(id=transaction_id).one()
-            except sqa.exc.NoResultFound:
+            # Only tag ids are needed, names come from the tag tree.
+            # A transaction without tags yields a single row with NULL tag_id.
+            tag_ids = session.scalars(
+                sqa.select(db.transactions_tags.c.tag_id)
+                .select_from(db.Transaction)
+                .outerjoin(db.transactions_tags)
+                .where(db.Transaction.id == transaction_id)
+            ).all()
+            if not tag_ids:
                 raise MpayException(f"There is no transaction with id={transaction_id}")
-            return {t.hierarchical_name for t in transaction.tags}
+            tag_tree = db.get_tag_tree(session)
+            return {tag_tree[tag_id] for tag_id in tag_ids if tag_id is not None}
 
     def create_agent(
         self,
@@ -293,33 +461,31 @@ class Mpay:
         original_amount: Optional[Decimal] = None,
         agent_name: Optional[str] = None,
         note: Optional[str] = None,
-        tag_hierarchical_names: Iterable[str] = [],
+        tag_hierarchical_names: Iterable[str] = (),
     ) -> int:
         recipient_name = self.sanitize_user_name(recipient_name)
         if due is None:
             due = datetime.datetime.now()
+        # floats are accepted in place of Decimal
+        converted_amount = _to_decimal(converted_amount)
+        if original_amount is not None:
+            original_amount = _to_decimal(original_amount)
 
         with db.Session(self.db_engine) as session:
-            try:
-                sender = session.query(db.User).filter_by(name=self.config.user).one()
-            except sqa.exc.NoResultFound:
-                raise MpayException("current user does not exist in the database")
-
-            try:
-                recipient = session.query(db.User).filter_by(name=recipient_name).one()
-            except sqa.exc.NoResultFound:
+            sender_id = self._get_current_user_id(session)
+            recipient_id = db.get_id_by(session, db.User.name, recipient_name)
+            if recipient_id is None:
                 raise MpayException("recipient user does not exist")
 
             # This is already checked by the db, but a python check will give
             # a more user-friendly error message.
-            if sender == recipient:
+            if sender_id == recipient_id:
                 raise MpayException("recipient must not be the same as the current user")
 
-            currency = None
+            currency_id = None
             if original_currency is not None:
-                try:
-                    currency = session.query(db.Currency).filter_by(iso_4217=original_currency).one()
-                except sqa.exc.NoResultFound:
+                currency_id = db.get_id_by(session, db.Currency.iso_4217, original_currency)
+                if currency_id is None:
                     raise MpayValueError("original_currency is not a known currency")
 
             agent = None
@@ -330,6 +496,7 @@ class Mpay:
                     if not self.ask_confirmation(f"Agent {agent_name} does not exist. Create?"):
                         raise MpayException(f"agent {agent_name} does not exist")
                     agent = db.Agent(name=agent_name)
+                    session.add(agent)
 
             # This should just work. If user enters "naive" timestamp on the
             # CLI, it will be interpreted as local time. If user enters
@@ -337,36 +504,42 @@ class Mpay:
             # into account.
             due_utc = due.astimezone(datetime.timezone.utc)
 
+            # skip repeated names, tags are deduplicated by id below
+            tag_hierarchical_names = list(dict.fromkeys(tag_hierarchical_names))
+            found_tags = self.find_tags(tag_hierarchical_names, session)
             tags = []
             for tag_hierarchical_name in tag_hierarchical_names:
-                try:
-                    tag = self.find_tag(tag_hierarchical_name, session)
-                except sqa.exc.NoResultFound:
+                tag = found_tags.get(tag_hierarchical_name)
+                if tag is None:
                     if not self.ask_confirmation(f"Tag {tag_hierarchical_name} does not exist. Create?"):
                         raise MpayException(f"tag {tag_hierarchical_name} does not exist")
                     tag = self.create_hierarchical_tag(tag_hierarchical_name, session)
+                    found_tags[tag_hierarchical_name] = tag
                 tags.append(tag)
 
             if converted_amount >= 0:
-                s, r = sender, recipient
+                s, r = sender_id, recipient_id
             else:
-                s, r = recipient, sender
-
-            t = db.Transaction(
-                user_from=s,
-                user_to=r,
-                user_created=sender,
-                converted_amount=abs(converted_amount),
-                original_amount=abs(original_amount) if original_amount is not None else None,
-                original_currency=currency,
-                agent=agent,
-                note=note,
-                dt_due_utc=due_utc,
-                tags=tags,
-            )
-            session.add(t)
+                s, r = recipient_id, sender_id
+
+            # assign ids to a newly created agent and tags
+            session.flush()
+            # Core insert, the ORM Transaction object would not be used
+            [transaction_id] = db.bulk_create_transactions(session, [{
+                "user_from_id": s,
+                "user_to_id": r,
+                "user_created_id": sender_id,
+                "converted_amount": abs(converted_amount),
+                "original_amount": abs(original_amount) if original_amount is not None else None,
+                "original_currency_id": currency_id,
+                "agent_id": agent.id if agent is not None else None,
+                "note": note,
+                "dt_due_utc": due_utc,
+                # names such as "t" and " t" resolve to the same tag
+                "tag_ids": list(dict.fromkeys(tag.id for tag in tags)),
+            }], return_ids=True)
             session.commit()
-            return t.id
+            return transaction_id
 
     def import_df(
         self,
@@ -406,47 +579,47 @@ class Mpay:
                     raise MpayException(f"agent {agent_name} does not exist")
                 agent = db.Agent(name=agent_name)
                 session.add(agent)
+                # we need agent.id for the bulk insert
+                session.flush()
 
-            try:
-                user1 = session.query(db.User).filter_by(name=user1_name).one()
-            except sqa.exc.NoResultFound:
+            user_ids = db.get_ids_by(session, db.User.name, [user1_name, user2_name])
+            user1_id = user_ids[user1_name]
+            if user1_id is None:
                 raise MpayException(f"user1 ({user1_name}) does not exist")
-            try:
-                user2 = session.query(db.User).filter_by(name=user2_name).one()
-            except sqa.exc.NoResultFound:
+            user2_id = user_ids[user2_name]
+            if user2_id is None:
                 raise MpayException(f"user2 ({user2_name}) does not exist")
 
-            user1_balance = Decimal("0")
-            count = 0
-            for _, row in df.iterrows():
-                _LOGGER.debug("import row: %r", row)
-                amount = Decimal(row.amount)
-                if amount > 0:
-                    user_from, user_to = user2, user1
-                elif amount <= 0:
-                    user_from, user_to = user1, user2
-
-                note: Optional[str] = row.note
-                # convert empty string to None
-                if not note:
-                    note = None
-
-                dt_due_utc = datetime.datetime.fromisoformat(row.dt_due).astimezone(datetime.timezone.utc)
-
-                user1_balance += amount
-                count += 1
-
-                t = db.Transaction(
-                    user_from=user_from,
-                    user_to=user_to,
-                    user_created=user_from,
-                    converted_amount=abs(amount),
-                    agent=agent,
-                    note=note,
-                    dt_due_utc=dt_due_utc
-                )
-
-                session.add(t)
+            amounts = df["amount"].map(_to_decimal)
+            positive = (amounts > 0).to_numpy()
+            user_from_ids = np.where(positive, user2_id, user1_id).tolist()
+            user_to_ids = np.where(positive, user1_id, user2_id).tolist()
+            # convert empty string to None
+            notes = [note if note else None for note in df["note"]]
+            # Naive timestamps are interpreted as local time, so this cannot
+            # be replaced with pd.to_datetime(utc=True).
+            dts_due_utc = [
+                datetime.datetime.fromisoformat(dt_due).astimezone(datetime.timezone.utc)
+                for dt_due in df["dt_due"]
+            ]
+
+            user1_balance = amounts.sum()
+            count = len(df)
+            rows = [
+                {
+                    "user_from_id": user_from_id,
+                    "user_to_id": user_to_id,
+                    "user_created_id": user_from_id,
+                    "converted_amount": abs(amount),
+                    "agent_id": agent.id,
+                    "note": note,
+                    "dt_due_utc": dt_due_utc,
+                }
+                for user_from_id, user_to_id, amount, note, dt_due_utc
+                in zip(user_from_ids, user_to_ids, amounts, notes, dts_due_utc)
+            ]
+
+            db.bulk_create_transactions(session, rows)
 
             if not self.ask_confirmation(f"{count} transactions imported, "
                                          f"final balance difference for user1: {user1_balance}. "
@@ -455,46 +628,60 @@ class Mpay:
 
             session.commit()
 
-    def _execute_order(self, order: db.StandingOrder, session) -> None:
+    def _execute_order(self, order: db.StandingOrder, utc_now: datetime.datetime) -> list[dict]:
+        """Schedule the next payment of a standing order.
+
+        :param utc_now: current time as a naive UTC datetime
+        :return: rows for db.bulk_create_transactions with the payments that
+                 are due
+        """
         dt_next_utc = order.dt_next_utc
         if dt_next_utc is None:
             # expired or disabled order
-            return
-
-        utc_now = datetime.datetime.now(datetime.timezone.utc)
-
-        while (dt_next_utc is not None and
-               dt_next_utc.replace(tzinfo=datetime.timezone.utc) <= utc_now
-               ):
-            # pay
-            t = db.Transaction(
-                user_from=order.user_from,
-                user_to=order.user_to,
-                user_created=order.user_from,
-                converted_amount=order.amount,
-                dt_due_utc=dt_next_utc,
-                standing_order=order
-            )
-            session.add(t)
-
-            # schedule next payment
-            r = dateutil.rrule.rrulestr(order.rrule_str)
-            prev_utc = dt_next_utc
-            # we'll feed it naive utc datetime and get a naive utc result
-            new_utc = r.after(dt_next_utc)
-            assert new_utc is None or new_utc > prev_utc
-            order.dt_next_utc = new_utc
-            dt_next_utc = new_utc
-            session.add(order)
-
-        session.commit()
+            return []
+
+        if dt_next_utc > utc_now:
+            return []
+
+        r = _parse_rrule(order.rrule_str)
+        # All due payments at once. rrule iterates from dtstart on every
+        # call, so calling r.after() for each payment would be quadratic.
+        dts_due_utc = [dt_next_utc]
+        dts_due_utc.extend(dt for dt in r.between(dt_next_utc, utc_now, inc=True) if dt > dt_next_utc)
+
+        # schedule next payment
+        order.dt_next_utc = r.after(utc_now)
+
+        # read the order's attributes once, not once per payment
+        row = {
+            "user_from_id": order.user_from_id,
+            "user_to_id": order.user_to_id,
+            "user_created_id": order.user_from_id,
+            "converted_amount": order.amount,
+            "standing_order_id": order.id,
+        }
+        return [{**row, "dt_due_utc": dt_due_utc} for dt_due_utc in dts_due_utc]
 
     def execute_orders(self) -> None:
+        """Create payments for all standing orders that are due.
+
+        All orders are executed in a single database transaction.
+        """
         with db.Session(self.db_engine) as session:
             utc_now = datetime.datetime.now(datetime.timezone.utc)
-            orders = session.query(db.StandingOrder).filter(db.StandingOrder.dt_next_utc < utc_now)
-            for order in orders:
-                self._execute_order(order, session)
+            orders = session.scalars(
+                sqa.select(db.StandingOrder)
+                # range scan on the dt_next_utc index
+                .where(db.StandingOrder.dt_next_utc < utc_now)
+                .order_by(db.StandingOrder.dt_next_utc)
+                .execution_options(yield_per=100)
+            )
+            # we'll feed the rrule naive utc datetimes and get naive utc results
+            naive_utc_now = utc_now.replace(tzinfo=None)
+            rows = [row for order in orders for row in self._execute_order(order, naive_utc_now)]
+            db.bulk_create_transactions(session, rows)
+            # The changed dt_next_utc values are flushed here, the ORM
+            # batches them into one executemany UPDATE.
             session.commit()
 
     def create_order(
@@ -516,21 +703,16 @@ class Mpay:
             raise MpayValueError("amount must be greater than zero")
 
         with db.Session(self.db_engine) as session:
-            try:
-                sender = session.query(db.User).filter_by(name=self.config.user).one()
-            except sqa.exc.NoResultFound:
-                raise MpayException("current user does not exist in the database")
-
-            try:
-                recipient = session.query(db.User).filter_by(name=recipient_name).one()
-            except sqa.exc.NoResultFound:
+            sender_id = self._get_current_user_id(session)
+            recipient_id = db.get_id_by(session, db.User.name, recipient_name)
+            if recipient_id is None:
                 raise MpayException("recipient user does not exist")
 
             o = db.StandingOrder(
                 name=name,
                 rrule_str=str(rrule),
-                user_from=sender,
-                user_to=recipient,
+                user_from_id=sender_id,
+                user_to_id=recipient_id,
                 amount=amount,
                 note=note,
                 dt_next_utc=rrule[0]
@@ -546,25 +728,27 @@ class Mpay:
         order_name = self.sanitize_order_name(order_name)
 
         with db.Session(self.db_engine) as session:
+            user_id = self._get_current_user_id(session)
             try:
-                user = session.query(db.User).filter_by(name=self.config.user).one()
+                order_id, dt_next_utc = session.execute(
+                    sqa.select(db.StandingOrder.id, db.StandingOrder.dt_next_utc)
+                    .where(db.StandingOrder.name == order_name, db.StandingOrder.user_from_id == user_id)
+                ).one()
             except sqa.exc.NoResultFound:
-                raise MpayException("current user does not exist in the database")
-
-            try:
-                order = session.query(db.StandingOrder).filter_by(name=order_name, user_from=user).one()
-            except sqa.exc.NoResultFound:
-                raise MpayException(f"standing order {order_name} with user_from={user.name} does not exist")
+                raise MpayException(f"standing order {order_name} with user_from={self.config.user} does not exist")
 
-            if order.dt_next_utc is None:
+            if dt_next_utc is None:
                 # already disabled
                 return True
 
             if not self.ask_confirmation("This operation is irreversible. Proceed?"):
                 return False
 
-            order.dt_next_utc = None
-            session.add(order)
+            session.execute(
+                sqa.update(db.StandingOrder)
+                .where(db.StandingOrder.id == order_id)
+                .values(dt_next_utc=None)
+            )
             session.commit()
         return True
 
@@ -578,45 +762,71 @@ class Mpay:
         AssertionError is raised.
         """
         _LOGGER.info("executing database checks")
-        with db.Session(self.db_engine) as session:
-            dialect_name = self.db_engine.dialect.name
-            if "sqlite" in dialect_name.lower():
+        # plain Core connection, these statements do not need the ORM
+        with self.db_engine.connect() as conn:
+            if self.db_engine.dialect.name == "sqlite":
                 _LOGGER.warning("db engine is sqlite, running sqlite-specific checks")
-                integrity_result = session.execute(sqa.sql.text("PRAGMA integrity_check")).one()
+                integrity_result = conn.exec_driver_sql("PRAGMA integrity_check").one()
                 if integrity_result[0].lower().strip() != "ok":
                     raise AssertionError("sqlite PRAGMA integrity_check reported errors")
-                foreign_key_result = session.execute(sqa.sql.text("PRAGMA foreign_key_check")).all()
+                foreign_key_result = conn.exec_driver_sql("PRAGMA foreign_key_check").all()
                 if len(foreign_key_result) != 0:
                     raise AssertionError("sqlite foreign_key_check reported errors")
 
-            balance_sum = session.query(db.func.sum(db.User.balance)).scalar()
+            balance_sum = conn.execute(sqa.select(db.func.sum(db.User.balance))).scalar()
             _LOGGER.info("balance sum: %s", balance_sum)
-            # balance_sum could be None if there are no users in the table
-            if balance_sum != 0 and balance_sum is not None:
+            # balance_sum is None if there are no users in the table
+            if balance_sum is None:
+                # no users, so there cannot be any transactions either
+                return
+            if balance_sum != 0:
                 raise AssertionError("balance sum is non-zero")
 
+            # Without transactions, every balance must be zero. This is
+            # cheaper than aggregating an empty table per user.
+            if conn.execute(sqa.select(db.Transaction.id).limit(1)).first() is None:
+                nonzero = conn.execute(
+                    sqa.select(db.User.name)
+                    .where(sqa.func.round(db.User.balance, db.MONEY_SCALE) != 0)
+                    .limit(1)
+                ).scalar()
+                if nonzero is not None:
+                    raise AssertionError(f"non-zero balance without transactions for user {nonzero}")
+                return
+
             # TODO lock tables users, transactions - this seems to be MySQL
             # specific
 
-            users = session.query(db.User).all()
-            for user in users:
-                outgoing_sum = (
-                    session.query(db.func.sum(db.Transaction.converted_amount))
-                    .filter_by(user_from=user)
-                    .scalar()
+            # sum both directions per user in subqueries, so that both can
+            # use the user_from_id / user_to_id indexes
+            outgoing = (
+                sqa.select(
+                    db.Transaction.user_from_id.label("user_id"),
+                    db.func.sum(db.Transaction.converted_amount).label("amount_sum"),
                 )
-                incoming_sum = (
-                    session.query(db.func.sum(db.Transaction.converted_amount))
-                    .filter_by(user_to=user)
-                    .scalar()
+                .group_by(db.Transaction.user_from_id)
+                .subquery()
+            )
+            incoming = (
+                sqa.select(
+                    db.Transaction.user_to_id.label("user_id"),
+                    db.func.sum(db.Transaction.converted_amount).label("amount_sum"),
                 )
-                _LOGGER.info("user=%s, outgoing_sum=%s, incoming_sum=%s, balance=%s",
-                             user.name, outgoing_sum, incoming_sum, user.balance)
-
-                if outgoing_sum is None:
-                    outgoing_sum = 0
-                if incoming_sum is None:
-                    incoming_sum = 0
-
-                if incoming_sum - outgoing_sum != user.balance:
-                    raise AssertionError(f"balance does not match transaction sum for user {user.name}")
+                .group_by(db.Transaction.user_to_id)
+                .subquery()
+            )
+            outgoing_sum = sqa.func.coalesce(outgoing.c.amount_sum, 0)
+            incoming_sum = sqa.func.coalesce(incoming.c.amount_sum, 0)
+            # The comparison is done by the database, only mismatched users
+            # are returned. SQLite stores NUMERIC values with a fractional
+            # part as REAL, hence the rounding.
+            mismatched = conn.execute(
+                sqa.select(db.User.name, db.User.balance, outgoing_sum, incoming_sum)
+                .outerjoin(outgoing, outgoing.c.user_id == db.User.id)
+                .outerjoin(incoming, incoming.c.user_id == db.User.id)
+                .where(sqa.func.round(incoming_sum - outgoing_sum - db.User.balance, db.MONEY_SCALE) != 0)
+            ).all()
+            for row in mismatched:
+                _LOGGER.error("user=%s, balance=%s, outgoing_sum=%s, incoming_sum=%s", *row)
+            if mismatched:
+                raise AssertionError(f"balance does not match transaction sum for user {mismatched[0].name}")
@@ -1,3 +1,4 @@
+import contextlib
 import pytest
 import mpay
 import mpay.cli
@@ -5,9 +6,26 @@ from mpay import MpayException, MpayValueError
 import os
 import datetime
 import dateutil.rrule
+import pandas as pd
+import sqlalchemy as sqa
 from decimal import Decimal
 
 
+@contextlib.contextmanager
+def count_queries(engine):
+    """Collect SQL statements executed on engine."""
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    sqa.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        sqa.event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 def test_init():
     config = mpay.Config(user="test1", db_url="sqlite:///")
     mp = mpay.Mpay(config, setup_database=True)
@@ -26,11 +44,17 @@ def mpay_in_memory():
 @pytest.fixture
 def mpay_w_users(mpay_in_memory):
     mp = mpay_in_memory
-    mp.create_user("test1")
-    mp.create_user("test2")
+    mp.create_users(["test1", "test2"])
     return mp
 
 
+def disable_returning(monkeypatch, mp):
+    """Make the dialect behave like MySQL, which has no RETURNING."""
+    for attr in ("insert_returning", "insert_executemany_returning",
+                 "insert_executemany_returning_sort_by_parameter_order"):
+        monkeypatch.setattr(mp.db_engine.dialect, attr, False)
+
+
 def test_init_twice(mpay_in_memory):
     mp = mpay_in_memory
     # the currencies upsert should not fail:
@@ -114,36 +138,44 @@ def test_user(mpay_in_memory):
     assert len(users) == 2
     assert set(users["name"]) == {"test1", "u2"}
 
+    with mpay.db.Session(mp.db_engine) as session:
+        assert mpay.db.get_id_by(session, mpay.db.User.name, "u3") is None
+        # the cached miss is invalidated when users change
+        session.add(mpay.db.User(name="u3", balance=0))
+        session.flush()
+        assert mpay.db.get_id_by(session, mpay.db.User.name, "u3") is not None
 
-def test_pay(mpay_w_users):
-    mp = mpay_w_users
+    mp.create_users(["u4", "u5"])
+    assert set(mp.get_users_dataframe()["name"]) == {"test1", "u2", "u4", "u5"}
 
-    # invalid recipient
-    with pytest.raises(MpayException):
-        mp.pay(recipient_name="idontexist", converted_amount=Decimal("12.3"),
-               due=datetime.datetime(2004, 1, 1))
 
-    # paying to self
-    with pytest.raises(MpayException):
-        mp.pay(recipient_name="test1", converted_amount=Decimal("12.3"),
-               due=datetime.datetime(2004, 1, 1))
+@pytest.mark.parametrize("kwargs, exception", [
+    ({"recipient_name": "idontexist"}, MpayException),
+    ({"recipient_name": "test1"}, MpayException),
+    ({"due": datetime.datetime.now() + datetime.timedelta(days=1)}, Exception),
+    ({"tag_hierarchical_names": ["tag1", "tag2"]}, MpayException),
+    ({"agent_name": "agent1"}, MpayException),
+], ids=["invalid recipient", "paying to self", "due is in future", "missing tags", "missing agent"])
+def test_pay_errors(mpay_w_users, kwargs, exception):
+    mp = mpay_w_users
+    mp.create_tag("tag1")
 
-    # due is in future
-    with pytest.raises(Exception):
-        mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
-               due=datetime.datetime.now() + datetime.timedelta(days=1))
+    kwargs = {
+        "recipient_name": "test2",
+        "converted_amount": Decimal("12.3"),
+        "due": datetime.datetime(2004, 1, 1),
+        **kwargs,
+    }
+    with pytest.raises(exception):
+        mp.pay(**kwargs)
 
-    mp.create_tag("tag1")
+    mp.check()
 
-    # missing tags
-    with pytest.raises(MpayException):
-        mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
-               due=datetime.datetime(2004, 1, 1), tag_hierarchical_names=["tag1", "tag2"])
 
-    # missing agent
-    with pytest.raises(MpayException):
-        mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
-               due=datetime.datetime(2004, 1, 1), agent_name="agent1")
+def test_pay(mpay_w_users):
+    mp = mpay_w_users
+
+    mp.create_tag("tag1")
 
     # this should work
     mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
@@ -171,8 +203,37 @@ def test_pay(mpay_w_users):
            due=datetime.datetime(2004, 1, 5))
 
     with mpay.db.Session(mp.db_engine) as session:
-        user = session.query(mpay.db.User).filter_by(name="test2").one()
-        assert user.balance == Decimal("3.2")
+        balance = session.execute(
+            sqa.select(mpay.db.User.balance).where(mpay.db.User.name == "test2")
+        ).scalar_one()
+        assert balance == Decimal("3.2")
+
+    mp.check()
+
+    # the cached current user id follows config changes
+    mp.config.user = "test2"
+    with pytest.raises(MpayException):
+        mp.pay(recipient_name="test2", converted_amount=Decimal("1"),
+               due=datetime.datetime(2004, 1, 6))
+    mp.pay(recipient_name="test1", converted_amount=Decimal("3.2"),
+           due=datetime.datetime(2004, 1, 6))
+    with mpay.db.Session(mp.db_engine) as session:
+        balances = dict(session.execute(sqa.select(mpay.db.User.name, mpay.db.User.balance)).all())
+        assert balances == {"test1": Decimal("0"), "test2": Decimal("0")}
+
+
+def test_pay_without_returning(mpay_w_users, monkeypatch):
+    mp = mpay_w_users
+    disable_returning(monkeypatch, mp)
+    mp.create_tag("tag1")
+
+    t1_id = mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
+                   due=datetime.datetime(2004, 1, 1), tag_hierarchical_names=["tag1"])
+    t2_id = mp.pay(recipient_name="test2", converted_amount=Decimal("1"),
+                   due=datetime.datetime(2004, 1, 2))
+    assert t2_id == t1_id + 1
+    assert mp.get_tags_for_transaction(t1_id) == {"tag1"}
+    assert mp.get_tags_for_transaction(t2_id) == set()
 
     mp.check()
 
@@ -220,21 +281,29 @@ def test_order(mpay_w_users):
     )
 
     with mpay.db.Session(mp.db_engine) as session:
-        user = session.query(mpay.db.User).filter_by(name="test2").one()
-        assert user.balance == Decimal("0")
+        balance = session.execute(
+            sqa.select(mpay.db.User.balance).where(mpay.db.User.name == "test2")
+        ).scalar_one()
+        assert balance == Decimal("0")
 
     mp.execute_orders()
 
     mp.check()
 
     with mpay.db.Session(mp.db_engine) as session:
-        user = session.query(mpay.db.User).filter_by(name="test2").one()
-        assert user.balance == Decimal("6.03")
-
-        o1 = session.query(mpay.db.StandingOrder).filter_by(name="order1").one()
-        assert o1.dt_next_utc == today + datetime.timedelta(days=1)
-        o2 = session.query(mpay.db.StandingOrder).filter_by(name="order2").one()
-        assert o2.dt_next_utc is None
+        balance = session.execute(
+            sqa.select(mpay.db.User.balance).where(mpay.db.User.name == "test2")
+        ).scalar_one()
+        assert balance == Decimal("6.03")
+
+        orders = {
+            o.name: o for o in session.scalars(
+                sqa.select(mpay.db.StandingOrder)
+                .where(mpay.db.StandingOrder.name.in_(["order1", "order2"]))
+            )
+        }
+        assert orders["order1"].dt_next_utc == today + datetime.timedelta(days=1)
+        assert orders["order2"].dt_next_utc is None
 
     assert not mp.disable_order("order1")
     mp.ask_confirmation = lambda question: True
@@ -297,6 +366,11 @@ def test_hierarchical_tag(mpay_w_users):
     mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
            due=datetime.datetime(2004, 1, 1), tag_hierarchical_names=["tag1", "a/b/tag2"])
 
+    # duplicate tag names are only linked once
+    t_id = mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
+                  due=datetime.datetime(2004, 1, 1), tag_hierarchical_names=["tag1", "tag1", " tag1", "a/b/tag2"])
+    assert mp.get_tags_for_transaction(t_id) == {"tag1", "a/b/tag2"}
+
     # /tag2 is not a duplicate of a/b/tag2:
     mp.pay(recipient_name="test2", converted_amount=Decimal("12.3"),
            due=datetime.datetime(2004, 1, 1), tag_hierarchical_names=["tag2"])
@@ -306,7 +380,12 @@ def test_hierarchical_tag(mpay_w_users):
         assert tag1.parent is None
 
         b = session.query(mpay.db.Tag).filter_by(name="b").one()
-        a_b_tag2 = session.query(mpay.db.Tag).filter_by(name="tag2", parent=b).one()
+        # load all ancestors up front instead of one lazy load per level
+        a_b_tag2 = session.scalars(
+            sqa.select(mpay.db.Tag)
+            .filter_by(name="tag2", parent=b)
+            .options(sqa.orm.selectinload(mpay.db.Tag.parent, recursion_depth=-1))
+        ).one()
         assert a_b_tag2.parent.name == "b"
         assert a_b_tag2.parent.parent.name == "a"
         assert a_b_tag2.parent.parent.parent is None
@@ -315,6 +394,24 @@ def test_hierarchical_tag(mpay_w_users):
         tag2 = session.query(mpay.db.Tag).filter_by(name="tag2", parent=None).one()
         assert tag2.hierarchical_name == "tag2"
 
+        tag_tree = mpay.db.get_tag_tree(session)
+        assert tag_tree == {t.id: t.hierarchical_name for t in session.query(mpay.db.Tag)}
+
+        # only mpay sessions are hooked
+        assert not sqa.event.contains(sqa.orm.Session, "after_flush", mpay.db._invalidate_caches)
+
+        # the cached tree is invalidated when tags change
+        session.add(mpay.db.Tag(name="tag3", parent=b))
+        session.flush()
+        assert set(mpay.db.get_tag_tree(session).values()) == {"tag1", "tag2", "a", "a/b", "a/b/tag2", "a/b/tag3"}
+
+    mp.create_tag("tag4", "description", parent_hierarchical_name="a/b")
+    with pytest.raises(MpayException):
+        mp.create_tag("tag5", parent_hierarchical_name="a/tag2")
+    with mpay.db.Session(mp.db_engine) as session:
+        tag4 = mp.find_tag("a/b/tag4", session)
+        assert tag4.description == "description"
+
 
 def test_add_tag(mpay_w_users):
     mp = mpay_w_users
@@ -325,24 +422,77 @@ def test_add_tag(mpay_w_users):
                    due=datetime.datetime(2004, 1, 1),
                    tag_hierarchical_names=["tag1", "a/b/tag2"])
 
-    t2_id = mp.pay(recipient_name="test2", converted_amount=Decimal("1.3"),
-                   due=datetime.datetime(2004, 1, 2),
-                   tag_hierarchical_names=["a/b/tag2"])
+    with count_queries(mp.db_engine) as queries:
+        t2_id = mp.pay(recipient_name="test2", converted_amount=Decimal("1.3"),
+                       due=datetime.datetime(2004, 1, 2),
+                       tag_hierarchical_names=["a/b/tag2"])
+    # recipient, tag tree, tags, transaction, tag links - no per-tag or
+    # per-segment queries
+    assert len(queries) <= 5
 
     # the tag should be created automatically
     mp.add_tags((t1_id, t2_id), ("a/b/tag3",))
 
     mp.remove_tags((t1_id, t2_id), ("a/b/tag2",))
 
+    assert mp.get_tags_for_transaction(t1_id) == {"a/b/tag3", "tag1"}
+    assert mp.get_tags_for_transaction(t2_id) == {"a/b/tag3"}
+
+
+def test_import_df(mpay_w_users):
+    mp = mpay_w_users
+    # auto create agent
+    mp.ask_confirmation = lambda question: True
+
+    df = pd.DataFrame({
+        "amount": [12.3, -2.3, 0],
+        "dt_due": ["2004-01-01T00:00:00", "2004-01-02T12:00:00+01:00", "2004-01-03"],
+        "note": ["first", "", "zero"],
+    })
+    mp.import_df(df, user1_name="test1", user2_name="test2", agent_name="csvimport")
+
+    mp.check()
+
     with mpay.db.Session(mp.db_engine) as session:
-        t1 = session.query(mpay.db.Transaction).filter_by(id=t1_id).one()
-        t2 = session.query(mpay.db.Transaction).filter_by(id=t2_id).one()
+        balance = session.execute(
+            sqa.select(mpay.db.User.balance).where(mpay.db.User.name == "test1")
+        ).scalar_one()
+        assert balance == Decimal("10")
 
-        t1_tags = {t.hierarchical_name for t in t1.tags}
-        t2_tags = {t.hierarchical_name for t in t2.tags}
+        transactions = session.query(mpay.db.Transaction).order_by(mpay.db.Transaction.id).all()
+        assert len(transactions) == 3
+        assert [t.note for t in transactions] == ["first", None, "zero"]
+        assert all(t.agent.name == "csvimport" for t in transactions)
+        assert transactions[1].user_from.name == "test1"
+        assert transactions[1].dt_due_utc == datetime.datetime(2004, 1, 2, 11, 0)
 
-        assert t1_tags == {"a/b/tag3", "tag1"}
-        assert t2_tags == {"a/b/tag3"}
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_bulk_create_transactions(mpay_w_users, monkeypatch, returning):
+    mp = mpay_w_users
+    if not returning:
+        disable_returning(monkeypatch, mp)
+    with mpay.db.Session(mp.db_engine) as session:
+        tag = mpay.db.Tag(name="tag1")
+        session.add(tag)
+        session.flush()
+        test1 = mpay.db.get_id_by(session, mpay.db.User.name, "test1")
+        test2 = mpay.db.get_id_by(session, mpay.db.User.name, "test2")
+        row = {"user_from_id": test1, "user_to_id": test2, "user_created_id": test1,
+               "dt_due_utc": datetime.datetime(2004, 1, 1)}
+        ids = mpay.db.bulk_create_transactions(session, [
+            {**row, "converted_amount": Decimal("1.5"), "tag_ids": [tag.id]},
+            {**row, "converted_amount": Decimal("2")},
+            {**row, "converted_amount": Decimal("3"), "tag_ids": [tag.id]},
+        ], batch_size=2, return_ids=True)
+        session.commit()
+
+        assert len(ids) == 3
+        amounts = [session.get(mpay.db.Transaction, i).converted_amount for i in ids]
+        assert amounts == [Decimal("1.5"), Decimal("2"), Decimal("3")]
+        assert [t.id for t in tag.transactions] == [ids[0], ids[2]]
+
+    mp.check()
 
 
 def test_mpay_cli(mpay_in_memory):
@@ -416,14 +566,12 @@ def test_mpay_cli(mpay_in_memory):
     execute_cli(["admin", "check"])
 
     with mpay.db.Session(mp.db_engine) as session:
-        users = session.query(mpay.db.User).all()
-        assert len(users) == 3
-        johndoe = session.query(mpay.db.User).filter_by(name="johndoe").one()
-        alice = session.query(mpay.db.User).filter_by(name="alice").one()
-        bob = session.query(mpay.db.User).filter_by(name="bob").one()
-        assert johndoe.balance == Decimal("-145.93")
-        assert bob.balance == Decimal("128.4")
-        assert alice.balance == Decimal("17.53")
+        balances = dict(session.execute(sqa.select(mpay.db.User.name, mpay.db.User.balance)).all())
+        assert balances == {
+            "johndoe": Decimal("-145.93"),
+            "bob": Decimal("128.4"),
+            "alice": Decimal("17.53"),
+        }
 
         t1 = session.query(mpay.db.Transaction).filter_by(note="first payment from johndoe to bob").one()
         t1_id = t1.id
@@ -445,15 +593,10 @@ def test_mpay_cli(mpay_in_memory):
     execute_cli(["tag", "remove", "--transactions", f"{t2_id}",
                  "--tags", "examples/tags"])
 
-    with mpay.db.Session(mp.db_engine) as session:
-        t1 = session.query(mpay.db.Transaction).filter_by(id=t1_id).one()
-        t2 = session.query(mpay.db.Transaction).filter_by(id=t2_id).one()
-
-        t1_tags = {t.hierarchical_name for t in t1.tags}
-        t2_tags = {t.hierarchical_name for t in t2.tags}
-
-        assert t1_tags == {"examples/tag_add/1", "examples/tag_add/2"}
-        assert t2_tags == {"examples/tag_add/1", "examples/tag_add/2", "examples/foreign_currency"}
+    assert mp.get_tags_for_transaction(t1_id) == {"examples/tag_add/1", "examples/tag_add/2"}
+    assert mp.get_tags_for_transaction(t2_id) == {
+        "examples/tag_add/1", "examples/tag_add/2", "examples/foreign_currency"
+    }
 
 
 def test_config():